@@ -1,4 +1,16 @@
 from inc_noesis import *
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_U32 = struct.Struct('<I')
+_ENTRY = struct.Struct('<HhII48sI')
+
+# row order inside every 4-row palette block, the middle two are swapped
+_PALETTE_ROW_ORDER = [0, 2, 1, 3]
 
 def registerNoesisTypes():
     handle = noesis.register("Red Faction 2 textures", ".peg")
@@ -11,6 +23,11 @@ def unswizzle_8bit_palette(palette):
     if len(palette) != 1024:
         raise ValueError("Input must be 1024 bytes bytes, got {})".format(len(palette)))
     
+    if np is not None:
+        # 8 blocks of 4 rows by 32 bytes
+        rows = np.frombuffer(palette, dtype=np.uint8).reshape(8, 4, 32)
+        return rows[:, _PALETTE_ROW_ORDER, :].tobytes()
+        
     result = bytearray(1024)
     
     # Process each 128-byte block
@@ -36,6 +53,23 @@ def unswizzle_8bit_palette(palette):
             result[dest:dest + 32] = palette[src:src + 32]
     
     return result     
+
+def decode_rgba5551_palette(palette):
+    # rapi does the 5 to 8 bit expansion, so the colors match what Noesis
+    # shows for the same data elsewhere
+    return unswizzle_8bit_palette(rapi.imageDecodeRaw(palette, 16, 16, "r5g5b5a1"))
+
+_ALPHA_LUT = bytes(255 if i == 128 else i for i in range(256))
+
+def fix_alpha(data, npix):
+    # 128 is fully opaque on PS2, stretch it to 255 in place
+    if np is not None:
+        alpha = np.frombuffer(data, dtype=np.uint8, count=npix * 4)[3::4]
+        alpha[alpha == 128] = 255
+        return
+        
+    end = npix * 4
+    data[3:end:4] = data[3:end:4].translate(_ALPHA_LUT)
      
 class PEGTexture:  
     def __init__(self, filename = "", width = 0, height = 0, data = None): 
@@ -46,76 +80,100 @@ class PEGTexture:
 
 
 class PEGFileEntry:
-    def __init__(self, reader):
-        self.filereader = reader
-        self.offset = 0
-        self.width = 0         
-        self.height = 0    
-        self.flags = 0            
-        self.flags2 = 0       
-        self.name = 0
-        self.offset = 0
-
-    def read(self):
-        self.width = self.filereader.readUShort()            
-        self.height = self.filereader.readShort()     
-        self.flags = self.filereader.readUInt()                       
-        self.flags2 = self.filereader.readUInt()            
-        self.name = noeAsciiFromBytes(self.filereader.readBytes(48))  
-        self.offset = self.filereader.readUInt()         
+    SIZE = 64
+    __slots__ = ("width", "height", "flags", "flags2", "name", "offset")
+    
+    def __init__(self, width = 0, height = 0, flags = 0, flags2 = 0, name = "", offset = 0):
+        self.width = width         
+        self.height = height    
+        self.flags = flags            
+        self.flags2 = flags2       
+        self.name = name
+        self.offset = offset
   
 class PEGImage:
-    def __init__(self, reader):
-        self.filereader = reader
+    HEADER_SIZE = 32
+    
+    def __init__(self, data):
+        # everything is read from data at explicit offsets, there is no
+        # shared stream position to seek
+        self.data = data
+        self.view = memoryview(data)
         self.entries = []
         self.num = 0
         
     def parseHeader(self):
-        magic = self.filereader.readUInt()
+        magic = _U32.unpack_from(self.data, 0)[0]
         if magic != 1447773511:
             return 1
             
-        self.filereader.seek(12, NOESEEK_REL)                 
-        self.num = self.filereader.readUInt()  
-        self.filereader.seek(32, NOESEEK_ABS) 
+        self.num = _U32.unpack_from(self.data, 16)[0]  
 
         return 0
         
-    def getImages(self):
-        for image in self.entries:
-            self.filereader.seek(image.offset, NOESEEK_ABS) 
-            if image.flags & 0xFF == 7:
-                data = self.filereader.readBytes(image.width * image.height * 4)            
-                imageDecodedData = rapi.imageDecodeRaw(data, image.width, image.height, "r8g8b8a8") 
-            elif image.flags & 0xFF == 4:
-                if ((image.flags & 0xFF00) >> 8) == 2:                            
-                    data = self.filereader.readBytes(1024)
-                elif ((image.flags & 0xFF00) >> 8) == 1:                
-                    palData = self.filereader.readBytes(512)
-                    data =  rapi.imageDecodeRaw(palData, 16, 16, "r5g5b5a1")
-                    
-                palData = unswizzle_8bit_palette(data)                     
-                pixelData = self.filereader.readBytes(image.width * image.height)  
-                
-                imageDecodedData = rapi.imageDecodeRawPal(pixelData, palData, image.width, image.height, 8, "r8g8b8a8")
-            elif image.flags & 0xFF == 3:
-                data = self.filereader.readBytes(image.width * image.height * 2)            
-                imageDecodedData = rapi.imageDecodeRaw(data, image.width, image.height, "r5g5b5a1")                 
+    def readImageData(self, image):
+        npix = image.width * image.height
+        pos = image.offset
+        if image.flags & 0xFF == 7:
+            return None, self.data[pos:pos + npix * 4]            
+        elif image.flags & 0xFF == 4:
+            if ((image.flags & 0xFF00) >> 8) == 2:                            
+                palSize = 1024
+            elif ((image.flags & 0xFF00) >> 8) == 1:                
+                palSize = 512
             else:
-                print("Unsupported texture type {}".format(image.flags & 0xFF))
-                imageDecodedData = None
+                return None, None
+            # the palette is followed by the pixels. the NumPy unswizzle reads
+            # a 32-bit palette as a view of data, rapi needs its own bytes
+            palSrc = self.view if np is not None and palSize == 1024 else self.data
+            return palSrc[pos:pos + palSize], self.data[pos + palSize:pos + palSize + npix]  
+        elif image.flags & 0xFF == 3:
+            return None, self.data[pos:pos + npix * 2]            
             
-            # remove alpha channel
-            for i in range(0, image.width * image.height * 4, 4):           
-                if imageDecodedData[i + 3] == 128:
-                   imageDecodedData[i + 3] = 255            
-            yield PEGTexture(image.name, image.width, image.height, imageDecodedData)          
+        return None, None
+        
+    def decodeImage(self, image, palData, data):
+        width, height = image.width, image.height
+        npix = width * height
+        # 1-bit alpha only expands to 0 or 255, so only 8-bit alpha needs the fixup
+        needs_alpha_fixup = False
+        if data is None:
+            print("Unsupported texture type {}".format(image.flags & 0xFF))
+            imageDecodedData = None
+        elif image.flags & 0xFF == 7:
+            imageDecodedData = rapi.imageDecodeRaw(data, width, height, "r8g8b8a8") 
+            needs_alpha_fixup = True
+        elif image.flags & 0xFF == 4:
+            if ((image.flags & 0xFF00) >> 8) == 1:                
+                palData = decode_rgba5551_palette(palData)
+            else:
+                palData = unswizzle_8bit_palette(palData)                     
+                needs_alpha_fixup = True
+                
+            imageDecodedData = rapi.imageDecodeRawPal(data, palData, width, height, 8, "r8g8b8a8")
+        else:
+            imageDecodedData = rapi.imageDecodeRaw(data, width, height, "r5g5b5a1")                 
+        
+        # remove alpha channel
+        if needs_alpha_fixup:
+            fix_alpha(imageDecodedData, npix)
+        return PEGTexture(image.name, width, height, imageDecodedData)          
+        
+    def getImages(self):
+        # one image at a time on the calling thread, rapi is not known to be
+        # safe to call from anywhere else
+        for image in self.entries:
+            palData, data = self.readImageData(image)
+            yield self.decodeImage(image, palData, data)
              
     def readEntries(self):
-        for _ in range(self.num):
-            fileEntry = PEGFileEntry(self.filereader)
-            fileEntry.read()
-            self.entries.append(fileEntry)            
+        self.entries = [None] * self.num
+        start = self.HEADER_SIZE
+        for i in range(self.num):
+            width, height, flags, flags2, name, offset = \
+                _ENTRY.unpack_from(self.data, start + i * PEGFileEntry.SIZE)
+            name = name.split(b'\x00', 1)[0].decode('ascii', 'ignore')
+            self.entries[i] = PEGFileEntry(width, height, flags, flags2, name, offset)            
                              
     def read(self):
         self.parseHeader()
@@ -129,10 +187,13 @@ def pegCheckType(data):
 
 def pegLoadRGBA(data, texList):
     # noesis.logPopup() 
-    imageFile = PEGImage(NoeBitStream(data))       
+    imageFile = PEGImage(data)       
     imageFile.read() 
       
     for image in imageFile.getImages(): 
+        # unsupported types were already reported by decodeImage
+        if image.data is None:
+            continue
         texture = NoeTexture(image.filename, image.width, image.height, image.data, noesis.NOESISTEX_RGBA32)       
         texList.append(texture)
         
@@ -11,10 +11,12 @@ Examples:
 """
 
 import os
+import mmap
 import struct
 import sys
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
@@ -24,6 +26,11 @@ TOC_DIR = "pc_media\\All_Levels\\"
 TOC_NAME = "All_Levels"
 TOC_REL_PATH = "pc_media\\All_Levels\\All_Levels.packfile"
 OUT_DIR = "extracted/"
+COPY_BUFSIZE = 1024 * 1024
+UNPACK_WORKERS = 8
+
+U32 = struct.Struct('<I')
+U32_PAIR = struct.Struct('<II')
 
 
 class Entry:
@@ -33,39 +40,79 @@ class Entry:
         self.offset = offset
         
 
-def read_null_terminated_string(file_obj):
-    chars = []
-    while True:
-        char = file_obj.read(1)
-        if not char or char == b'\x00':
-            break
-        chars.append(char)
-    return b''.join(chars).decode('utf-8', errors='ignore')
+def read_null_terminated_string(data, pos):
+    end = data.find(b'\x00', pos)
+    if end == -1:
+        end = len(data)
+    return data[pos:end].decode('utf-8', errors='ignore'), end + 1
 
 def write_null_terminated_string(file_obj, string):
-    file_obj.write(string.encode('utf-8'))
-    file_obj.write(b'\x00')
+    file_obj.write(string.encode('utf-8') + b'\x00')
+
+def copy_file_data(src, dst, offset, length):
+    # Let the kernel move the bytes (Linux), otherwise copy in bounded chunks.
+    # src is only read at explicit offsets, so threads can share it where
+    # os.pread is available
+    try:
+        while length > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), length, offset)
+            if copied == 0:
+                return
+            offset += copied
+            length -= copied
+        return
+    except (AttributeError, OSError):
+        pass
+        
+    while length > 0:
+        size = min(length, COPY_BUFSIZE)
+        if hasattr(os, 'pread'):
+            chunk = os.pread(src.fileno(), size, offset)
+        else:
+            src.seek(offset)
+            chunk = src.read(size)
+        if not chunk:
+            break
+        # dst is unbuffered, a single write may take only part of the chunk
+        data = memoryview(chunk)
+        while data:
+            data = data[dst.write(data):]
+        offset += len(chunk)
+        length -= len(chunk)
+
+def walk_files(directory):
+    # DirEntry carries the file type from the directory listing, so only
+    # the size needs a stat call
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file():
+                yield entry.path, entry.name, entry.stat().st_size
+            elif entry.is_dir(follow_symlinks = False):
+                yield from walk_files(entry.path)
   
 def unpack(toc_group_file, output_dir = None):
     if not os.path.exists(toc_group_file):
         raise FileNotFoundError(f"toc_group file not found: {toc_group_file}")
     
-    with open(toc_group_file, 'rb') as f:
+    with open(toc_group_file, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
         # Read header
-        name = read_null_terminated_string(f)
+        name, pos = read_null_terminated_string(mm, 0)
         if name != TOC_NAME:
             raise Exception(f"Wrong {TOC_FILENAME} file. First string must be {TOC_NAME} not {name}")
-        dir = read_null_terminated_string(f)
-        type, unk = struct.unpack('<II', f.read(8))
-        packfile_path = read_null_terminated_string(f)
+        dir, pos = read_null_terminated_string(mm, pos)
+        type, unk = U32_PAIR.unpack_from(mm, pos)
+        packfile_path, pos = read_null_terminated_string(mm, pos + 8)
         
         # Read number of files
-        num_files = struct.unpack('<I', f.read(4))[0]
+        num_files = U32.unpack_from(mm, pos)[0]
+        pos += 4
         
         file_entries = []
         for _ in range(num_files):
-            filename = read_null_terminated_string(f)
-            length, offset = struct.unpack('<II', f.read(8))
+            filename, pos = read_null_terminated_string(mm, pos)
+            length, offset = U32_PAIR.unpack_from(mm, pos)
+            pos += 8
             print(filename)
             file_entries.append(Entry(filename, length, offset))
        
@@ -84,19 +131,35 @@ def unpack(toc_group_file, output_dir = None):
     os.makedirs(output_dir, exist_ok = True)
     
     # Extract files
-    extracted_files = 0
-    with open(packfile_path, 'rb') as packfile:
-        for entry in file_entries:
-            packfile.seek(entry.offset)
-            file_data = packfile.read(entry.length)
+    def extract(entry):
+        output_path = os.path.join(output_dir, entry.filename)
+        
+        with open(output_path, 'wb', buffering = 0) as out_file:
+            copy_file_data(packfile, out_file, entry.offset, entry.length)
             
-            output_path = os.path.join(output_dir, entry.filename)
+    # Entries with the same file name (pack stores base names only) go to one
+    # worker in TOC order, so they never write the same file at once and the
+    # last one still wins
+    groups = {}
+    for entry in file_entries:
+        groups.setdefault(os.path.normcase(entry.filename), []).append(entry)
             
-            with open(output_path, 'wb') as out_file:
-                out_file.write(file_data)
+    def extract_group(entries):
+        for entry in entries:
+            extract(entry)
+        return len(entries)
             
-            extracted_files += 1
-            print(f"Extracted: {entry.filename} ({entry.length} bytes)")
+    # Without positional reads the entries share one file position
+    workers = UNPACK_WORKERS if hasattr(os, 'pread') else 1
+    
+    # Walk the packfile front to back so reads stay sequential
+    batches = sorted(groups.values(), key = lambda entries: entries[0].offset)
+    
+    extracted_files = 0
+    with open(packfile_path, 'rb') as packfile, \
+         ThreadPoolExecutor(max_workers = workers) as executor:
+        for count in executor.map(extract_group, batches):
+            extracted_files += count
     
     print(f"\nExtracted {extracted_files} files to: {output_dir}")
     return output_dir
@@ -123,38 +186,35 @@ def pack(input_dir, output_toc = None, output_packfile = None):
     
     # Prepare file entries
     file_entries = []
+    file_paths = []
     offset = 0
 
-    for file_path in input_dir.rglob('*'):
-        if file_path.is_file():
-            size = file_path.stat().st_size
-            file_entries.append(Entry(file_path.name, size, offset))
-            offset += size
+    for file_path, filename, size in walk_files(input_dir):
+        file_entries.append(Entry(filename, size, offset))
+        file_paths.append(file_path)
+        offset += size
             
     # Write packfile
-    with open(output_packfile, 'wb') as packfile:
-        for entry in file_entries:      
-            with open(os.path.join(input_dir, entry.filename), 'rb') as infile:
-                packfile.write(infile.read())
+    with open(output_packfile, 'wb', buffering = 0) as packfile:
+        for file_path, entry in zip(file_paths, file_entries):      
+            with open(file_path, 'rb') as infile:
+                copy_file_data(infile, packfile, 0, entry.length)
     
     # Write toc_group file
     with open(output_toc, 'wb') as toc_file:
         # Write header
         write_null_terminated_string(toc_file, TOC_NAME)
         write_null_terminated_string(toc_file, TOC_DIR)
-        toc_file.write(struct.pack('<I', 2))
-        toc_file.write(struct.pack('<I', 1))
+        toc_file.write(U32_PAIR.pack(2, 1))
         
         write_null_terminated_string(toc_file, TOC_REL_PATH)
         
-        # Write number of files
-        toc_file.write(struct.pack('<I', len(file_entries)))
-        
-        # Write file entries
+        # Write number of files and the file entries in one go
+        parts = [U32.pack(len(file_entries))]
         for entry in file_entries:
-            write_null_terminated_string(toc_file, entry.filename)
-            toc_file.write(struct.pack('<I', entry.length))
-            toc_file.write(struct.pack('<I', entry.offset))
+            parts.append(entry.filename.encode('utf-8') + b'\x00')
+            parts.append(U32_PAIR.pack(entry.length, entry.offset))
+        toc_file.write(b''.join(parts))
     
     print(f"  toc_group: {output_toc}")
     print(f"  packfile: {output_packfile}")
@@ -1,15 +1,34 @@
 import os
 import sys
+import mmap
 import struct
 import struct
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from typing import Optional, Tuple, BinaryIO, Iterator, List
 from dataclasses import dataclass, field
 from tga import TGAFile
 import utils
 
 
-@dataclass
+_PEG_HDR_STRUCT = struct.Struct('<IIIIIII')
+_PEG_ENTRY_STRUCT = struct.Struct('<HHBBBBBBH')
+_PEG_OFFSET_STRUCT = struct.Struct('<I')
+# a whole 64-byte entry: the numeric fields, the name and the offset
+_PEG_ENTRY_RECORD_STRUCT = struct.Struct('<HHBBBBBBH48sI')
+# num_images and frame_num, read from offset 16 of the header
+_PEG_HDR_COUNTS_STRUCT = struct.Struct('<I4xI')
+_IO_BUF = 1 << 20
+_SAVE_WORKERS = 4
+# images read ahead of the saves, bounds the raw frames held in memory
+_SAVE_QUEUE = 2 * _SAVE_WORKERS
+# PEG texture type for each TGA depth, indexed by depth >> 3
+_PEG_TYPE_BY_DEPTH = (0, 4, 3, 0, 7)
+
+
+@dataclass(slots = True)
 class PEGFileEntry:
     width: int = 0
     height: int = 0
@@ -23,13 +42,12 @@ class PEGFileEntry:
     name: str = ""
     offset: int = 0
 
+    SIZE = 64
+    
     @classmethod
-    def from_file(cls, reader: BinaryIO) -> 'PEGFileEntry':
-        width, height, img_type, subtype, u1, frame_num, anim_delay, mipmaps, u2 = \
-            struct.unpack('<HHBBBBBBH', reader.read(12))
-        
-        name = utils.get_cstring(reader.read(48))       
-        offset = struct.unpack('<I', reader.read(4))[0]
+    def from_record(cls, record: Tuple, name: str) -> 'PEGFileEntry':
+        # name is the record's name field, already decoded by utils.get_cstrings
+        width, height, img_type, subtype, u1, frame_num, anim_delay, mipmaps, u2, _, offset = record
         
         return cls(
             width = width, 
@@ -46,13 +64,13 @@ class PEGFileEntry:
         )
 
 
-@dataclass        
+@dataclass(slots = True)        
 class RF2ImageFileFrame:
-    data: bytes
+    data: bytes # or a uint8 ndarray, see utils.change_pixel_order
     palette: bytes
     
 
-@dataclass        
+@dataclass(slots = True)        
 class RF2ImageFile:
     name: str = ""
     width: int = 0
@@ -60,6 +78,31 @@ class RF2ImageFile:
     depth: int = 0
     palette_depth: int = 0
     frames: List[RF2ImageFileFrame] = field(default_factory=list)
+    raw: bool = False # frames still in PEG channel and palette order
+    
+    def decode(self) -> None:
+        # PEG to TGA channel and palette order, for images read with decode = False
+        if not self.raw:
+            return
+        for frame in self.frames:
+            if self.depth == 8:
+                frame.palette = utils.reorder_palette(frame.palette, self.palette_depth)
+            else:
+                # the raw copy belongs to the frame, so convert it in place
+                frame.data = utils.change_pixel_order(frame.data, self.depth, inplace = True)
+        self.raw = False
+    
+    def to_rgba(self, frame: RF2ImageFileFrame) -> bytes:
+        if self.depth == 32:
+            return frame.data
+        if self.depth == 16:
+            return utils.expand_rgba5551(frame.data)
+        if self.depth == 8:
+            palette = frame.palette
+            if self.palette_depth == 16:
+                palette = utils.expand_rgba5551(palette)
+            return utils.apply_palette(frame.data, palette)
+        raise ValueError(f"Can't expand {self.depth}-bit image to RGBA")
      
 
 class PEGImageArchive:
@@ -77,32 +120,80 @@ class PEGImageArchive:
         self.dummy = 0
         self.frame_num = 0
         self.unk = 16
+        
+        self._mm: Optional[mmap.mmap] = None
+    
+    def __enter__(self) -> 'PEGImageArchive':
+        return self
+    
+    def __exit__(self, *exc) -> None:
+        self.close()
     
     def read(self) -> None:
+        # keep the archive mapped, extract_images reads the frames from it
         with open(self.file_path, 'rb') as f:
-            self._parse_header(f)
-            self._read_entries(f)
+            self._mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self._parse_header(self._mm)
+        self._read_entries(self._mm)
+
+    def read_header_only(self) -> None:
+        # just the counts, for listings that never touch the entries
+        with open(self.file_path, 'rb', buffering = 0) as f:
+            header = f.read(32)
+        if header[:4] != self.MAGIC:
+            raise ValueError(f"Invalid PEG file (magic: {header[:4]})")
+        if len(header) < 32:
+            raise ValueError(f"Truncated PEG header ({len(header)} bytes)")
+        
+        self.num_images, self.frame_num = _PEG_HDR_COUNTS_STRUCT.unpack_from(header, 16)
 
-    def _parse_header(self, f: BinaryIO) -> None:
-        magic = f.read(4)
+    def close(self) -> None:
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # views of the mapping are still alive somewhere, it is
+                # unmapped once the last of them goes away
+                pass
+            self._mm = None
+
+    def _parse_header(self, data: bytes) -> None:
+        magic = data[:4]
         if magic != self.MAGIC:
             raise ValueError(f"Invalid PEG file (magic: {magic})")
         
         (self.version, self.entries_data_size, self.files_data_size,
          self.num_images, self.dummy, self.frame_num, self.unk) = \
-            struct.unpack('<IIIIIII', f.read(28))
-
-    def _read_entries(self, f: BinaryIO) -> None:
-        for _ in range(self.num_images):
-            self.entries.append(PEGFileEntry.from_file(f))
+            _PEG_HDR_STRUCT.unpack_from(data, 4)
+
+    def _read_entries(self, data: bytes) -> None:
+        start = 32
+        end = start + self.num_images * PEGFileEntry.SIZE
+        # one copy of the table, then a single C loop over its records
+        records = list(_PEG_ENTRY_RECORD_STRUCT.iter_unpack(data[start:end]))
+        names = utils.get_cstrings(record[9] for record in records)
+        self.entries = [PEGFileEntry.from_record(record, name)
+                        for record, name in zip(records, names)]
+
+    def extract_images(self, decode: bool = True) -> Iterator[RF2ImageFile]:
+        # with decode = False the frames are plain copies of the archive bytes
+        # and RF2ImageFile.decode does the conversion later, off this loop
+        if self._mm is None:
+            self.read()
+            
+        view = memoryview(self._mm)
+        try:
+            for i in self._read_order():
+                yield self._read_image_data(view, self.entries[i], decode)
+        finally:
+            view.release()
 
-    def extract_images(self) -> Iterator[RF2ImageFile]:
-        with open(self.file_path, 'rb') as f:
-            for entry in self.entries:
-                yield self._read_image_data(f, entry)
+    def _read_order(self) -> List[int]:
+        # entry indices by offset, so the file is walked front to back
+        return sorted(range(len(self.entries)), key = lambda i: self.entries[i].offset)
 
-    def _read_image_data(self, f: BinaryIO, entry: PEGFileEntry) -> Tuple[str, int, int, int, int, bytes]:
-        f.seek(entry.offset)
+    def _read_image_data(self, view: memoryview, entry: PEGFileEntry, decode: bool = True) -> RF2ImageFile:
+        pos = entry.offset
         depth = 0
         palette_depth = 32
         image_data = None
@@ -124,59 +215,74 @@ class PEGImageArchive:
                 raise ValueError(f"Unsupported texture type: {entry.type}")
 
             image = RF2ImageFile(name = entry.name, width = entry.width, \
-                height = entry.height, depth = depth, palette_depth = palette_depth)
+                height = entry.height, depth = depth, palette_depth = palette_depth, raw = not decode)
+            npix = entry.width * entry.height
+            palette_size = 256 * palette_depth // 8
+            frame_size = npix * (depth // 8)
             for _ in range(entry.frame_num):
                 if depth == 8:
-                    palette_bytes = utils.change_pixel_order(f.read(256 * palette_depth // 8), palette_depth)
-                    palette_data = utils.unswizzle_8bit_palette(palette_bytes)                    
-                    image_data = f.read(entry.width * entry.height)
+                    palette_data = view[pos:pos + palette_size]
+                    if decode:
+                        palette_data = utils.reorder_palette(palette_data, palette_depth)
+                    else:
+                        palette_data = palette_data.tobytes()
+                    pos += palette_size
+                    image_data = view[pos:pos + npix].tobytes()
+                    pos += npix
                 else:
-                    image_data = utils.change_pixel_order(f.read(entry.width * entry.height * (depth // 8)), depth)
+                    image_data = view[pos:pos + frame_size]
+                    if decode:
+                        image_data = utils.change_pixel_order(image_data, depth)
+                    else:
+                        image_data = bytearray(image_data)
+                    pos += frame_size
                 
                 image.frames.append(RF2ImageFileFrame(image_data, palette_data))
                 
             return image
 
         except Exception as e:
-            raise ValueError(f"Failed to decode image '{entry.name}': {e}")
+            message = f"Failed to decode image '{entry.name}': {e}"
+        # raised out here with the slices dropped, a traceback still holding
+        # views of the mapping would keep close() from unmapping it
+        del image_data, palette_data
+        raise ValueError(message)
 
     def write(self) -> None:
-        with open(self.file_path, 'wb') as f:
+        with open(self.file_path, 'wb', buffering = _IO_BUF) as f:
             self._write_header(f)
             self._write_entries(f)
             self._write_image_data(f)
 
     def _write_header(self, f: BinaryIO) -> None:
-        f.write(self.MAGIC)
-        f.write(struct.pack('<III', 
+        f.write(self.MAGIC + _PEG_HDR_STRUCT.pack(
             self.version, 
             len(self.entries) * 64, 
-            sum(len(data) for data in self.image_data)))
-        f.write(struct.pack('<I', len(self.entries)))
-        f.write(struct.pack('<III', 0, 0, 0))
+            sum(len(data) for data in self.image_data),
+            len(self.entries), 0, 0, 0))
 
     def _write_entries(self, f: BinaryIO) -> None:
-        current_offset = 28 + len(self.entries) * 64
+        # the image data follows the header and the entry table directly
+        current_offset = 32 + len(self.entries) * PEGFileEntry.SIZE
+        buf = bytearray(len(self.entries) * PEGFileEntry.SIZE)
         
         for i, entry in enumerate(self.entries):
             entry.offset = current_offset
-            size = len(self.image_data[i])
+            base = i * PEGFileEntry.SIZE
             
-            f.seek(28 + i * 64)
-            f.write(struct.pack('<HHBBBBBBH', 
+            _PEG_ENTRY_STRUCT.pack_into(buf, base,
                 entry.width, entry.height, entry.type, entry.subtype,
-                entry.u1, entry.frame_num, entry.anim_delay, entry.mipmaps, entry.u2))
-            
+                entry.u1, entry.frame_num, entry.anim_delay, entry.mipmaps, entry.u2)
             name_bytes = entry.name.encode('ascii', errors='ignore')[:47]
-            f.write(name_bytes.ljust(48, b'\x00'))
-            f.write(struct.pack('<I', entry.offset))
+            buf[base + 12:base + 12 + len(name_bytes)] = name_bytes
+            _PEG_OFFSET_STRUCT.pack_into(buf, base + 60, entry.offset)
             
-            current_offset += size
+            current_offset += len(self.image_data[i])
+        
+        f.write(buf)
 
     def _write_image_data(self, f: BinaryIO) -> None:
-        f.seek(self.entries[-1].offset if self.entries else 28)
-        for data in self.image_data:
-            f.write(data)
+        f.writelines(self.image_data)
 
 
 class PEGProcessor:
@@ -185,101 +291,125 @@ class PEGProcessor:
         if not os.path.isdir(peg_folder):
             raise FileNotFoundError(f"PEG folder not found: {peg_folder}") 
         
-        peg_files = [f for f in os.listdir(peg_folder) if f.lower().endswith('.peg')]
+        peg_files = PEGProcessor._scan_peg_files(peg_folder)
+        
+        lines = []
+        for peg_file in peg_files:
+            print(f"Processing: {peg_file.path}")            
+            try:                 
+                archive = PEGImageArchive(peg_file.path)
+                archive.read_header_only()
+                lines.append(f"{peg_file.name} {archive.num_images} {archive.frame_num}\n")                                            
+                   
+            except Exception as e:
+                print(f"  [ERROR] Failed to process {peg_file.name}: {e}") 
         
         filename = 'meta.txt'
         with open(filename, 'w') as meta_file:
-            for peg_file in peg_files:
-                peg_path = os.path.join(peg_folder, peg_file)
-                print(f"Processing: {peg_path}")            
-                try:                 
-                    archive = PEGImageArchive(peg_path)
-                    archive.read()
-                    meta_file.write(f"{peg_file} {archive.num_images} {archive.frame_num}\n")                                            
-                       
-                except Exception as e:
-                    print(f"  [ERROR] Failed to process {peg_file}: {e}") 
+            meta_file.write(''.join(lines))
                 
     @staticmethod
-    def unpack(peg_folder: str, output_folder: str) -> None:
+    def unpack(peg_folder: str, output_folder: str, rgba: bool = False, jobs: Optional[int] = None) -> None:
         if not os.path.isdir(peg_folder):
             raise FileNotFoundError(f"PEG folder not found: {peg_folder}")
 
         os.makedirs(output_folder, exist_ok=True)
-        peg_files = [f for f in os.listdir(peg_folder) if f.lower().endswith('.peg')]
+        peg_files = PEGProcessor._scan_peg_files(peg_folder)
         
         if not peg_files:
             print(f"No .peg files found in '{peg_folder}'")
             return
 
-        total_failed = 0
+        peg_paths = [peg_file.path for peg_file in peg_files]
+        unpack_one = partial(_unpack_one, output_folder = output_folder, rgba = rgba)
         
-        for peg_file in peg_files:
-            peg_path = os.path.join(peg_folder, peg_file)
-            print(f"\nProcessing: {peg_file}")
-            
-            try:
-                archive = PEGImageArchive(peg_path)
-                archive.read()
-                
-                archive_name = os.path.splitext(peg_file)[0]
-                archive_output_dir = os.path.join(output_folder, archive_name)
-                os.makedirs(archive_output_dir, exist_ok = True)
-                
-                failed = PEGProcessor._extract_archive(archive, archive_output_dir)
-                total_failed += failed
-                
-            except Exception as e:
-                print(f"  [ERROR] Failed to process {peg_file}: {e}")
-                total_failed += 1
+        # archives are independent, give each one its own process. each process
+        # also runs _SAVE_WORKERS save threads, so by default start only enough
+        # processes for about one thread per CPU
+        if jobs is None:
+            jobs = max(1, (os.cpu_count() or 1) // _SAVE_WORKERS)
+        jobs = min(jobs, len(peg_paths))
+        if jobs == 1:
+            total_failed = sum(map(unpack_one, peg_paths))
+        else:
+            # hand the archives out in batches, a few per worker, so a folder of
+            # small files is not one round trip per file
+            chunksize = max(1, len(peg_paths) // (jobs * 4))
+            with ProcessPoolExecutor(max_workers = jobs) as executor:
+                total_failed = sum(executor.map(unpack_one, peg_paths, chunksize = chunksize))
 
         print(f"\nCompleted with {total_failed} failures.")
 
     @staticmethod
-    def _extract_archive(archive: PEGImageArchive, output_dir: str) -> int:
+    def _scan_peg_files(peg_folder: str) -> List[os.DirEntry]:
+        # DirEntry already knows the file type and its full path
+        with os.scandir(peg_folder) as it:
+            return [e for e in it if e.name[-4:].lower() == '.peg' and e.is_file()]
+
+    @staticmethod
+    def _extract_archive(archive: PEGImageArchive, output_dir: str, rgba: bool = False) -> int:
         failed = 0
         
+        lines = [f"{i:<5} {entry.name:<30} {entry.width:<6} "
+                 f"{entry.height:<6} {entry.type:<4} "
+                 f"{entry.subtype:<4} {entry.u1:<4} "
+                 f"{entry.frame_num:<4} {entry.anim_delay:<4} {entry.mipmaps:<4} {entry.u2:<4}\n"
+                 for i, entry in enumerate(archive.entries)]
         with open(os.path.join(output_dir, 'meta.txt'), 'w') as meta_file:
-            for i, entry in enumerate(archive.entries):
-                meta_file.write(f"{i:<5} {entry.name:<30} {entry.width:<6} "
-                               f"{entry.height:<6} {entry.type:<4} "
-                               f"{entry.subtype:<4} {entry.u1:<4} "
-                               f"{entry.frame_num:<4} {entry.anim_delay:<4} {entry.mipmaps:<4} {entry.u2:<4}\n")
+            meta_file.write(''.join(lines))
+
+        # decode the next image while the previous ones are being written,
+        # waiting on the oldest save once _SAVE_QUEUE images are in flight
+        pending = deque()
+        with ThreadPoolExecutor(max_workers = _SAVE_WORKERS) as executor:
+            for image in archive.extract_images(decode = False):
+                if len(pending) >= _SAVE_QUEUE:
+                    failed += pending.popleft().result()
+                pending.append(executor.submit(PEGProcessor._save_image, image, output_dir, rgba))
+            while pending:
+                failed += pending.popleft().result()
+                
+        return failed
 
-        for image in archive.extract_images():
-            try:
-                name = image.name
-                if not image.name.lower().endswith('.tga'):
-                    name = f"{image.name}.tga"
-             
-                tga = TGAFile(
-                    width = image.width,
-                    height = image.height,
-                    depth = image.depth,
-                    palette = image.frames[0].palette,
-                    origin_bottom_left = False,
-                    image_data = image.frames[0].data,
-                    palette_depth = image.palette_depth
-                )
+    @staticmethod
+    def _save_image(image: RF2ImageFile, output_dir: str, rgba: bool = False) -> int:
+        failed = 0
+        
+        try:
+            name = image.name
+            image.decode()
+            if not image.name.lower().endswith('.tga'):
+                name = f"{image.name}.tga"
                 
-                if len(image.frames) == 1:
-                    output_path = os.path.join(output_dir, name)                  
+            expand = rgba and image.depth != 32
+            tga = TGAFile(
+                width = image.width,
+                height = image.height,
+                depth = 32 if expand else image.depth,
+                palette = image.frames[0].palette,
+                origin_bottom_left = False,
+                image_data = image.to_rgba(image.frames[0]) if expand else image.frames[0].data,
+                palette_depth = image.palette_depth
+            )
+            
+            if len(image.frames) == 1:
+                output_path = os.path.join(output_dir, name)                  
+                failed += 1 - tga.save(output_path)
+                print(f"  Extracted: {name}")
+            else:
+                filepath_without_ext = os.path.splitext(name)[0]
+                for i, frame in enumerate(image.frames):                       
+                    name = f"{filepath_without_ext}___frame_{i + 1}.tga"
+                    output_path = os.path.join(output_dir, name)
+                    tga.image_data = image.to_rgba(frame) if expand else frame.data
+                    tga.palette = frame.palette
                     failed += 1 - tga.save(output_path)
-                    print(f"  Extracted: {name}")
-                else:
-                    filepath_without_ext = os.path.splitext(name)[0]
-                    for i, frame in enumerate(image.frames):                       
-                        name = f"{filepath_without_ext}___frame_{i + 1}.tga"
-                        output_path = os.path.join(output_dir, name)
-                        tga.image_data = frame.data
-                        tga.pallete = frame.palette
-                        failed += 1 - tga.save(output_path)
-                        
-                    print(f"  Extracted: {name}")
-                
-            except Exception as e:
-                print(f"  [ERROR] Failed to extract {name}: {e}")
-                failed += 1
+                    
+                print(f"  Extracted: {name}")
+            
+        except Exception as e:
+            print(f"  [ERROR] Failed to extract {name}: {e}")
+            failed += 1
                 
         return failed
          
@@ -289,14 +419,13 @@ class PEGProcessor:
         if not os.path.exists(input_dir):
             raise FileNotFoundError(f"Input directory not found: {input_dir}")
 
-        folders = [f for f in os.listdir(input_dir) 
-                  if os.path.isdir(os.path.join(input_dir, f))]
+        with os.scandir(input_dir) as it:
+            folders = [e.path for e in it if e.is_dir()]
         
         if not folders:
             raise ValueError(f"No directories found in: {input_dir}")
 
-        for dir_name in folders:
-            peg_dir = os.path.join(input_dir, dir_name)
+        for peg_dir in folders:
             archive = PEGImageArchive(f"{peg_dir}.peg")
             
             try:
@@ -382,7 +511,40 @@ class PEGProcessor:
         print(f"\nCompleted with {failed} failures.")            
     @staticmethod
     def _get_image_type(depth: int) -> int:
-        return {32: 7, 16: 3, 8: 4}.get(depth, 0)
+        # 8 -> 4, 16 -> 3, 32 -> 7, anything else is unsupported
+        index = depth >> 3
+        if depth & 7 or not 0 <= index < len(_PEG_TYPE_BY_DEPTH):
+            return 0
+        return _PEG_TYPE_BY_DEPTH[index]
+
+
+def _unpack_one(peg_path: str, output_folder: str, rgba: bool = False) -> int:
+    peg_file = os.path.basename(peg_path)
+    print(f"\nProcessing: {peg_file}")
+    
+    try:
+        with PEGImageArchive(peg_path) as archive:
+            archive.read()
+            
+            archive_name = os.path.splitext(peg_file)[0]
+            archive_output_dir = os.path.join(output_folder, archive_name)
+            os.makedirs(archive_output_dir, exist_ok = True)
+            
+            return PEGProcessor._extract_archive(archive, archive_output_dir, rgba)
+        
+    except Exception as e:
+        print(f"  [ERROR] Failed to process {peg_file}: {e}")
+        return 1
+
+
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an integer: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def main():
@@ -395,6 +557,8 @@ def main():
     unpack_parser = subparsers.add_parser('unpack', help = 'Unpack .peg archives')
     unpack_parser.add_argument('peg_folder', help = 'Folder containing .peg files')
     unpack_parser.add_argument('output_folder', help = 'Output folder for extracted files')
+    unpack_parser.add_argument('--rgba', action = 'store_true', help = 'Save 16-bit and palettized textures as 32-bit RGBA TGA files')
+    unpack_parser.add_argument('-j', '--jobs', type = _positive_int, default = None, help = f'Number of archives to unpack in parallel, each with {_SAVE_WORKERS} save threads (default: CPU count / {_SAVE_WORKERS})')
     
     pack_parser = subparsers.add_parser('pack', help = 'Pack TGA files into .peg archives')
     pack_parser.add_argument('input_folder', help = 'Folder containing TGA files organized by archive')
@@ -406,7 +570,7 @@ def main():
     
     try:
         if args.command == 'unpack':
-            PEGProcessor.unpack(args.peg_folder, args.output_folder)
+            PEGProcessor.unpack(args.peg_folder, args.output_folder, args.rgba, args.jobs)
         elif args.command == 'pack':
             PEGProcessor.pack(args.input_folder)
         elif args.command == 'meta':
@@ -1,11 +1,20 @@
 import os
 import struct
-from typing import Optional, Tuple, BinaryIO
+from typing import Optional, Tuple, List
 from enum import IntEnum
 from dataclasses import dataclass
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-@dataclass
+
+_TGA_HDR_STRUCT = struct.Struct('<BBBHHBHHHHBB')
+_IO_BUF = 1 << 20
+
+
+@dataclass(slots = True)
 class TGAHeader:
     id_len: int = 0
     cmap_type: int = 0
@@ -48,6 +57,8 @@ class TGAFile:
         self.palette_depth = palette_depth
         self.origin_bottom_left = origin_bottom_left
         self.image_type = self._determine_image_type()
+        self._header_key = None
+        self._header = b''
 
     @property
     def filesize(self) -> int:
@@ -56,6 +67,16 @@ class TGAFile:
         image_bytes = self.width * self.height * (self.depth // 8)
         return header_size + palette_bytes + image_bytes
 
+    @property
+    def cached_header(self) -> bytes:
+        # frames of an animation share the header, only rebuild it when a field changes
+        key = (self.width, self.height, self.depth, self.image_type,
+               self.palette_size, self.palette_depth, self.origin_bottom_left)
+        if key != self._header_key:
+            self._header = self._build_header()
+            self._header_key = key
+        return self._header
+
     def _determine_image_type(self) -> ImageType:
         if self.depth == 8:
             return ImageType.PALETTED
@@ -63,10 +84,15 @@ class TGAFile:
 
     @classmethod
     def from_bytes(cls, data: bytes) -> 'TGAFile':
+        tga = cls()
+        tga._parse_into(data)
+        return tga
+
+    def _parse_into(self, data: bytes) -> None:
         if len(data) < 18:
             raise ValueError("File too small to be a valid TGA")
 
-        header = cls._parse_header(data)
+        header = self._parse_header(data)
         
         offset = 18 + header.id_len
         
@@ -77,41 +103,25 @@ class TGAFile:
             offset += palette_size
 
         image_size = header.width * header.height * (header.depth // 8)
-        image_data = data[offset:offset + image_size]
-
-        return cls(
-            width = header.width,
-            height = header.height,
-            depth = header.depth,
-            image_data = image_data,
-            palette = palette,
-            palette_size = header.cmap_len,
-            palette_depth = header.cmap_depth,
-            origin_bottom_left = bool(header.descriptor & 0x20)
-        )
+
+        self.width = header.width
+        self.height = header.height
+        self.depth = header.depth
+        self.image_data = data[offset:offset + image_size]
+        self.palette = palette
+        self.palette_size = header.cmap_len
+        self.palette_depth = header.cmap_depth
+        self.origin_bottom_left = bool(header.descriptor & 0x20)
+        self.image_type = self._determine_image_type()
 
     @staticmethod
     def _parse_header(data: bytes) -> TGAHeader:
-        return TGAHeader(
-            id_len = data[0],
-            cmap_type = data[1],
-            img_type = data[2],
-            cmap_start = struct.unpack('<H', data[3:5])[0],
-            cmap_len = struct.unpack('<H', data[5:7])[0],
-            cmap_depth = data[7],
-            x_origin = struct.unpack('<H', data[8:10])[0],
-            y_origin = struct.unpack('<H', data[10:12])[0],
-            width = struct.unpack('<H', data[12:14])[0],
-            height = struct.unpack('<H', data[14:16])[0],
-            depth = data[16],
-            descriptor=data[17]
-        )
+        return TGAHeader(*_TGA_HDR_STRUCT.unpack_from(data, 0))
 
     def load(self, file_path: str) -> bool:
         try:
-            with open(file_path, 'rb') as f:
-                tga = self.from_bytes(f.read())
-                self.__dict__.update(tga.__dict__)
+            with open(file_path, 'rb', buffering = _IO_BUF) as f:
+                self._parse_into(f.read())
             return True
         except (IOError, ValueError) as e:
             print(f"Error loading TGA {file_path}: {e}")
@@ -119,22 +129,48 @@ class TGAFile:
 
     def save(self, file_path: str) -> bool:
         try:
-            with open(file_path, 'wb') as f:
-                self._write(f)
+            # one open and, where os.writev exists, one write call per file
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+            try:
+                self._write_fd(fd)
+            finally:
+                os.close(fd)
             return True
         except IOError as e:
             print(f"Error saving TGA to {file_path}: {e}")
             return False
 
-    def _write(self, stream: BinaryIO) -> None:
-        stream.write(self._build_header())
+    def serialize(self) -> bytes:
+        return b''.join(self._chunks())
+
+    def _write_fd(self, fd: int) -> None:
+        chunks = self._chunks()
+        written = 0
+        if hasattr(os, 'writev'):
+            written = os.writev(fd, chunks)
+            if written == sum(memoryview(chunk).nbytes for chunk in chunks):
+                return
         
-        if self.depth == 8 and self.palette:
-            padded_palette = self.palette.ljust(self.palette_size * 4, b'\x00')
-            stream.write(padded_palette[:self.palette_size * 4])
+        # short write, or no writev on this platform
+        data = memoryview(self.serialize())[written:]
+        while data:
+            data = data[os.write(fd, data):]
 
-        data = self._prepare_image_data()
-        stream.write(data)
+    def _chunks(self) -> List[bytes]:
+        chunks = [self.cached_header]
+        
+        if self.depth == 8 and self.palette:
+            palette_bytes = self.palette_size * (self.palette_depth // 8)
+            if len(self.palette) == palette_bytes:
+                chunks.append(self.palette)
+            else:
+                padded_palette = bytearray(palette_bytes)
+                padded_palette[:len(self.palette)] = self.palette[:palette_bytes]
+                chunks.append(padded_palette)
+
+        # image_data can be any contiguous buffer, a uint8 ndarray is written without a copy
+        chunks.append(self._prepare_image_data())
+        return chunks
 
     def _build_header(self) -> bytes:
         cmap_type = 1 if self.depth == 8 else 0
@@ -145,25 +181,24 @@ class TGAFile:
         elif self.depth == 16:
             descriptor |= 0x01
 
-        header_bytes = b'\x00'
-        header_bytes += struct.pack('B', cmap_type)
-        header_bytes += struct.pack('B', self.image_type)
-        
         if cmap_type == 1:
-            header_bytes += struct.pack('<HHB', 0, self.palette_size, self.palette_depth)
+            cmap_len, cmap_depth = self.palette_size, self.palette_depth
         else:
-            header_bytes += b'\x00' * 5
+            cmap_len, cmap_depth = 0, 0
             
-        header_bytes += struct.pack('<HHHH', 0, 0, self.width, self.height)
-        header_bytes += struct.pack('BB', self.depth, descriptor)
-        
-        return header_bytes
+        return _TGA_HDR_STRUCT.pack(0, cmap_type, self.image_type, 0, cmap_len, cmap_depth,
+            0, 0, self.width, self.height, self.depth, descriptor)
 
     def _prepare_image_data(self) -> bytes:
         if self.origin_bottom_left or self.height <= 1:
             return self.image_data
 
         row_size = self.width * (self.depth // 8)
+        if np is not None and len(self.image_data) == row_size * self.height:
+            # reverse the rows as a negative stride, one copy on tobytes
+            rows = np.frombuffer(self.image_data, dtype=np.uint8).reshape(self.height, row_size)
+            return rows[::-1].tobytes()
+            
         rows = [self.image_data[i:i + row_size] 
                 for i in range(0, len(self.image_data), row_size)]
         return b''.join(reversed(rows))
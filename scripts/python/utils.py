@@ -1,7 +1,54 @@
-from typing import BinaryIO
+from typing import BinaryIO, Iterable, List, Union
 import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_PIXEL16 = struct.Struct('<H')
+
+# row order inside every 4-row palette block, the middle two are swapped
+_PALETTE_ROW_ORDER = [0, 2, 1, 3]
+
+# single pass, in place kernels for change_pixel_order, compiled by numba
+# when it is installed. they drop the GIL so conversions on worker threads
+# can overlap
+def _swap_rb32(pixels):
+    for i in range(0, pixels.size - 3, 4):
+        pixels[i], pixels[i + 2] = pixels[i + 2], pixels[i]
+
+def _swap_rb16(pixels):
+    for i in range(pixels.size):
+        pixel = pixels[i]
+        pixels[i] = (pixel & 0x83E0) | ((pixel >> 10) & 0x1F) | ((pixel & 0x1F) << 10)
+
+_jit_kernels = None
+
+def _get_jit_kernels():
+    # importing numba costs a few hundred ms, so it only happens the first
+    # time pixels are converted. (None, None) without NumPy or numba
+    global _jit_kernels
+    if _jit_kernels is None:
+        kernels = (None, None)
+        if np is not None:
+            try:
+                from numba import njit
+            except ImportError:
+                pass
+            else:
+                jit = njit(cache = True, nogil = True)
+                kernels = (jit(_swap_rb32), jit(_swap_rb16))
+        _jit_kernels = kernels
+    return _jit_kernels
 
 def unswizzle_8bit_palette(palette_bytes: bytes) -> bytes:
+    if np is not None and len(palette_bytes) % 32 == 0:
+        # 8 blocks of 4 rows
+        rows = np.frombuffer(palette_bytes, dtype=np.uint8).reshape(8, 4, -1)
+        return rows[:, _PALETTE_ROW_ORDER, :].tobytes()
+        
     result = bytearray(len(palette_bytes))
     block_size = len(palette_bytes) // 8
     sub_sizes = [block_size - (i * (block_size // 4)) for i in range(4)]
@@ -27,31 +74,118 @@ def unswizzle_8bit_palette(palette_bytes: bytes) -> bytes:
     return bytes(result)
 
 
-def change_pixel_order(data: bytes, depth: int = 32) -> bytes:
+def _pixels(data: bytes, inplace: bool, dtype) -> 'np.ndarray':
+    # data as a writable array: data's own memory when converting in place,
+    # otherwise a copy
+    if inplace:
+        return np.frombuffer(data, dtype=dtype)
+    return np.frombuffer(data, dtype=dtype).copy()
+
+def change_pixel_order(data: bytes, depth: int = 32, inplace: bool = False) -> Union[bytes, 'np.ndarray']:
+    # with NumPy the result stays a flat uint8 array, it is written out as is.
+    # with inplace the pixels are converted inside data, which must then be
+    # writable (a bytearray), and the result shares its memory
+    swap_rb32, swap_rb16 = _get_jit_kernels()
+    if swap_rb32 is not None and depth == 32 and len(data) % 4 == 0:
+        pixels = _pixels(data, inplace, np.uint8)
+        swap_rb32(pixels)
+        return pixels
+        
+    if swap_rb16 is not None and depth == 16 and len(data) % 2 == 0 and sys.byteorder == 'little':
+        pixels = _pixels(data, inplace, np.uint16)
+        swap_rb16(pixels)
+        return pixels.view(np.uint8)
+        
+    if np is not None and depth == 32 and len(data) % 4 == 0:
+        # copy once, then swap the R and B columns in place. this measured about
+        # twice as fast as uint64 SWAR masking or a four column gather
+        pixels = _pixels(data, inplace, np.uint8).reshape(-1, 4)
+        pixels[:, [0, 2]] = pixels[:, [2, 0]]
+        return pixels.reshape(-1)
+        
+    if np is not None and depth == 16 and len(data) % 2 == 0:
+        # alpha and green stay where they are, red and blue trade places
+        pixels = np.frombuffer(data, dtype='<u2')
+        swapped = (pixels & 0x83E0) | ((pixels >> 10) & 0x1F) | ((pixels & 0x1F) << 10)
+        if inplace:
+            pixels[:] = swapped
+            return pixels.view(np.uint8)
+        return swapped.astype('<u2', copy=False).view(np.uint8)
+        
     if depth == 32:
-        result = bytearray(data)
+        result = data if inplace else bytearray(data)
         for i in range(0, len(data), 4):
             result[i], result[i + 2] = data[i + 2], data[i]
-        return bytes(result)
+        return result if inplace else bytes(result)
 
     if depth == 16:
-        result = bytearray(len(data))
+        result = data if inplace else bytearray(len(data))
         for i in range(0, len(data), 2):
-            pixel = struct.unpack('<H', data[i:i + 2])[0]
+            pixel = _PIXEL16.unpack_from(data, i)[0]
             a = (pixel & 0x8000) >> 15
             r = (pixel & 0x7C00) >> 10
             g = (pixel & 0x03E0) >> 5
             b = pixel & 0x001F
             new_pixel = (a << 15) | (b << 10) | (g << 5) | r
-            result[i:i + 2] = struct.pack('<H', new_pixel)
-        return bytes(result)
+            _PIXEL16.pack_into(result, i, new_pixel)
+        return result if inplace else bytes(result)
 
     return data
+
+
+if np is not None:
+    # palette entry order after unswizzling, 8 entries per row in either depth
+    _PALETTE_ENTRY_ORDER = np.arange(256).reshape(8, 4, 8)[:, _PALETTE_ROW_ORDER, :].reshape(-1)
+    # the same order at byte level, with R and B of every 32-bit entry swapped
+    _PALETTE32_BYTE_ORDER = (_PALETTE_ENTRY_ORDER[:, None] * 4 + [2, 1, 0, 3]).reshape(-1)
+
+def reorder_palette(palette: bytes, depth: int = 32) -> bytes:
+    # change_pixel_order and unswizzle_8bit_palette in one pass over a full palette
+    if np is not None and depth == 32 and len(palette) == 1024:
+        return np.frombuffer(palette, dtype=np.uint8)[_PALETTE32_BYTE_ORDER].tobytes()
+        
+    if np is not None and depth == 16 and len(palette) == 512:
+        colors = np.frombuffer(palette, dtype='<u2')[_PALETTE_ENTRY_ORDER]
+        swap_rb16 = _get_jit_kernels()[1]
+        if swap_rb16 is not None and sys.byteorder == 'little':
+            swap_rb16(colors)
+            return colors.tobytes()
+        swapped = (colors & 0x83E0) | ((colors >> 10) & 0x1F) | ((colors & 0x1F) << 10)
+        return swapped.astype('<u2', copy=False).tobytes()
+        
+    return unswizzle_8bit_palette(change_pixel_order(palette, depth))
+
+_EXPAND_5BIT = bytes((x << 3) | (x >> 2) for x in range(32))
+
+def expand_rgba5551(data: bytes) -> bytes:
+    # A1R5G5B5 words (TGA order) to B8G8R8A8 pixels
+    if np is not None:
+        pixels = np.frombuffer(data, dtype='<u2')
+        result = np.empty((pixels.size, 4), dtype=np.uint8)
+        for i, shift in enumerate((0, 5, 10)):
+            channel = ((pixels >> shift) & 0x1F).astype(np.uint8)
+            result[:, i] = (channel << 3) | (channel >> 2)
+        result[:, 3] = (pixels >> 15).astype(np.uint8) * 255
+        return result.tobytes()
+        
+    result = bytearray(len(data) * 2)
+    for i, (pixel,) in enumerate(_PIXEL16.iter_unpack(data)):
+        result[i * 4:i * 4 + 4] = bytes((
+            _EXPAND_5BIT[pixel & 0x1F],
+            _EXPAND_5BIT[(pixel >> 5) & 0x1F],
+            _EXPAND_5BIT[(pixel >> 10) & 0x1F],
+            255 if pixel & 0x8000 else 0))
+    return bytes(result)
+
+def apply_palette(indices: bytes, palette: bytes) -> bytes:
+    # 8-bit indices to the 4-byte palette entries they point at
+    if np is not None:
+        colors = np.frombuffer(palette, dtype=np.uint8).reshape(-1, 4)
+        return colors[np.frombuffer(indices, dtype=np.uint8)].tobytes()
+        
+    colors = [palette[i:i + 4] for i in range(0, len(palette), 4)]
+    return b''.join(map(colors.__getitem__, indices))
     
-def get_cstring(data):
-    name = ""
-    null_pos = data.find(b'\x00')
-    name = data[:null_pos].decode('ascii', errors='ignore') \
-    if null_pos != -1 else data.decode('ascii', errors='ignore')
-    
-    return name
+def get_cstrings(fields: Iterable[bytes]) -> List[str]:
+    # null terminated ASCII names from a column of fixed-size fields, in one pass
+    return [field.split(b'\x00', 1)[0].decode('ascii', errors='ignore') for field in fields]